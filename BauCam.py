@@ -7,7 +7,7 @@ import subprocess
 import exifread
 import configparser
 import sqlite3
-from time import sleep
+from time import sleep, monotonic
 from datetime import datetime, timedelta, time
 import gpiozero
 import sys
@@ -30,6 +30,155 @@ class KillWatcher:
         self.shoot = True
 
 
+class CameraMonitor:
+    # failure classes derived from the gphoto2 output, checked in this order
+    failure_patterns = (
+        ('disconnected', ('no camera found', 'could not detect any camera', 'could not find the requested device',
+                          'unknown port')),
+        ('busy', ('device busy', 'camera is already busy', 'i/o in progress', 'could not claim the usb device')),
+        ('focus', ('out of focus', 'no focus', 'autofocus')),
+    )
+
+    def __init__(self, power, runner=subprocess.run, retry_count=8, probe_timeout=5, max_capture_timeout=20,
+                 min_capture_timeout=10, boot_timeout=15):
+        self.power = power
+        self.runner = runner    # replaceable for testing without a camera attached
+        self.retry_count = retry_count
+        self.probe_timeout = probe_timeout
+        self.max_capture_timeout = max_capture_timeout
+        self.min_capture_timeout = min_capture_timeout
+        self.boot_timeout = boot_timeout
+        self.latency = None     # moving average of successful capture durations in seconds
+        self.full_timeout = False   # use the maximum timeout until the next successful capture
+        self.reset_errors()
+
+    def reset_errors(self):
+        self.camera_error = 0   # failures counting towards the retry count
+        self.busy_error = 0     # busy failures retried before they count as failures
+        self.power_cycled = False
+        self.recovery_failed = False
+
+    def gphoto2(self, args, timeout):
+        out_bytes = self.runner(['gphoto2'] + args, timeout=timeout,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout
+        return str(out_bytes, 'utf-8', errors='replace')
+
+    def record_latency(self, seconds):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency = 0.7 * self.latency + 0.3 * seconds
+        self.full_timeout = False
+
+    def record_failure(self, seconds):
+        # a slow failed capture may have been cut short - quick failures say nothing about the capture time
+        if self.latency is not None and seconds > self.latency:
+            self.full_timeout = True
+
+    def widen_timeout(self):
+        # returns False if the capture already had the maximum timeout
+        if self.capture_timeout() >= self.max_capture_timeout:
+            return False
+        self.full_timeout = True
+        return True
+
+    def capture_timeout(self):
+        # allow three times the usual capture time, but stay within the configured limits
+        if self.latency is None or self.full_timeout:
+            return self.max_capture_timeout
+        return min(self.max_capture_timeout, max(self.min_capture_timeout, 3 * self.latency))
+
+    def classify_failure(self, output):
+        if output is None:
+            return 'timeout'
+        lower_output = output.lower()
+        for failure, patterns in self.failure_patterns:
+            for pattern in patterns:
+                if pattern in lower_output:
+                    return failure
+        return 'unknown'
+
+    def is_responsive(self):
+        # the camera list of --auto-detect starts after the dashed separator line
+        try:
+            output = self.gphoto2(['--auto-detect'], self.probe_timeout)
+        except subprocess.TimeoutExpired:
+            print('Timeout while probing the camera', flush=True)
+            return False
+        except OSError as e:
+            print('OS Error while probing the camera:', e, flush=True)
+            return False
+        lines = output.splitlines()
+        for index, line in enumerate(lines):
+            if line.startswith('---'):
+                return any(entry.strip() for entry in lines[index + 1:])
+        return False
+
+    def power_cycle(self):
+        self.power.off()
+        sleep(5)
+        self.power.on()
+        return self.wait_for_boot()
+
+    def wait_for_boot(self):
+        # poll the camera instead of waiting a fixed time for it to boot
+        start_time = monotonic()
+        while monotonic() - start_time < self.boot_timeout:
+            if self.is_responsive():
+                return True
+            sleep(1)
+        return False
+
+    def handle_failure(self, output, day):
+        # escalate from cheap to expensive recoveries: retry, probe, power cycle and only then reboot
+        # returns 'retry' to take the photo again right away and 'reboot' if nothing else is left
+        failure = self.classify_failure(output)
+        print('failure while photo taking: {}'.format(failure), flush=True)
+
+        if failure == 'timeout' and self.widen_timeout():
+            print('retrying with the maximum capture timeout', flush=True)
+            return 'retry'
+
+        if not day:
+            # reset error counters at night to avoid endless retries and reboots over night
+            self.reset_errors()
+            return None
+
+        if failure == 'busy' and self.busy_error < self.retry_count:
+            # retry a busy camera soon - it is usually held by another process which a power cycle can't fix
+            self.busy_error += 1
+            print('camera is busy - retry {} of {}'.format(self.busy_error, self.retry_count), flush=True)
+            return None
+
+        self.camera_error += 1
+        if failure != 'busy':
+            self.busy_error = 0
+        if self.power_cycled and failure != 'focus':
+            self.recovery_failed = True     # the failure repeats after a power cycle
+
+        if self.camera_error >= self.retry_count and self.recovery_failed:
+            return 'reboot'
+        if failure == 'focus':
+            print('camera could not focus - power cycle skipped', flush=True)
+        elif self.camera_error >= self.retry_count - 1 or failure == 'disconnected' or not self.is_responsive():
+            print('rebooting camera', flush=True)
+            self.power_cycled = True
+            if not self.power_cycle():
+                print('camera not responding after power cycle', flush=True)
+                self.recovery_failed = True
+        else:
+            print('camera is responsive - power cycle skipped', flush=True)
+
+        if not self.recovery_failed:
+            print('reboot pending a failed camera power cycle', flush=True)
+        elif self.camera_error >= self.retry_count:
+            print('The system will be rebooted after the next failure.', flush=True)
+        else:
+            print('The system will be rebooted after {} further failures.'.format(
+                self.retry_count - self.camera_error), flush=True)
+        return None
+
+
 def take_photo(capture_path, local_path, now):
     os.chdir(capture_path)
     pic_name = image_prefix + now.strftime('%Y-%m-%d_%H-%M-%S')
@@ -40,9 +189,9 @@ def take_photo(capture_path, local_path, now):
         os.remove(file_name)
 
     try:
-        out_bytes = subprocess.run(['gphoto2', '--capture-image-and-download'], timeout=20,
-                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout
-        output = str(out_bytes, 'utf-8')
+        start_time = monotonic()
+        output = monitor.gphoto2(['--capture-image-and-download'], monitor.capture_timeout())
+        duration = monotonic() - start_time
         final_names = [None]
         files = os.listdir()
         for file_name in files:
@@ -58,19 +207,21 @@ def take_photo(capture_path, local_path, now):
             jpeg_path = os.path.join(local_path, final_names[0])
             exif_tags, cam_time = extract_exif(jpeg_path)
             store_exif_in_database(now, output, cam_time=cam_time, file_names=final_names, exif_tags=exif_tags)
-            return True
+            monitor.record_latency(duration)
+            return True, output
         else:
             store_exif_in_database(now, output)
-            return False
+            monitor.record_failure(duration)
+            return False, output
 
     except subprocess.TimeoutExpired as e:
         print('Timeout while taking a photo...', flush=True)
-        return False
+        return False, None
     except Exception as e:
         print('Unknown exception:', flush=True)
         print(type(e), flush=True)
         print(e, flush=True)
-        return False
+        return False, str(e)
 
 
 def extract_exif(file_path):
@@ -248,17 +399,11 @@ def measure_and_store_climate(timestamp):
     conn.close()
 
 
-def restart_camera():
-    camera.off()
-    sleep(5)
-    camera.on()
-    sleep(5)
-
-
 def main_loop():
     last_photo = datetime.now() - photo_interval - timedelta(seconds=2)
     last_climate = datetime.now() - climate_interval - timedelta(seconds=2)
-    camera_error = 0
+    last_busy = datetime.now()
+    retry_now = False
     last_db_backup = datetime.now() - db_backup_interval
 
     interval_count = 1
@@ -276,6 +421,9 @@ def main_loop():
             photo_now = True
             print('taking photo on SIGUSR1 trigger', flush=True)
             watcher.shoot = False
+        if retry_now:
+            photo_now = True
+            retry_now = False
 
         day = True
         if not day_start < now.time() < day_end:
@@ -303,35 +451,35 @@ def main_loop():
                 print('no photo at {}. interval of {}'.format(interval_count, factor), flush=True)
             interval_count += 1
 
+        camera_error = monitor.camera_error
+        busy_error = monitor.busy_error
         if camera_error and now >= last_photo + timedelta(seconds=camera_error * rescue_interval):
             print('taking a rescue photo after {} failures'.format(camera_error), flush=True)
             photo_now = True
+        elif busy_error and now >= last_busy + timedelta(seconds=min(rescue_interval,
+                                                                     busy_error * 2 * monitor.capture_timeout())):
+            print('retrying busy camera after {} attempts'.format(busy_error), flush=True)
+            photo_now = True
 
         # take photo if it's time to take a photo
         if photo_now:
-            success = take_photo(capture_path, local_path, now)
+            success, output = take_photo(capture_path, local_path, now)
             if success:
-                camera_error = 0
+                monitor.reset_errors()
                 # use the time after a successful photo to archive files
                 remote_archive()
                 if now > last_db_backup + db_backup_interval:
                     db_backup()
                     last_db_backup = now
             else:
-                if day:
-                    camera_error += 1   # count errors only at day - avoid reboots over night
-                else:
-                    camera_error = 0    # reset error counter at night to avoid endless retries
-            if camera_error >= retry_count:
-                print('rebooting everything')
-                subprocess.run(['sudo', 'reboot'])  # works only on systems with sudo without password (RasPi)
-                sys.exit('reboot triggered')
-            if camera_error >= retry_count - 1:
-                print('rebooting camera', flush=True)
-                restart_camera()
-            if camera_error > 0:
-                print('failure while photo taking. The system will be rebooted '
-                      'after {} further failures.'.format(retry_count - camera_error), flush=True)
+                last_busy = now
+                action = monitor.handle_failure(output, day)
+                if action == 'retry':
+                    retry_now = True
+                elif action == 'reboot':
+                    print('rebooting everything')
+                    subprocess.run(['sudo', 'reboot'])  # works only on systems with sudo without password (RasPi)
+                    sys.exit('reboot triggered')
 
         if now >= last_climate + climate_interval:
 
@@ -401,6 +549,18 @@ if __name__ == '__main__':
     if general_conf.get('rescue interval') is None:
         general_conf['rescue interval'] = '300'
         changed = True
+    if general_conf.get('max capture timeout') is None:
+        general_conf['max capture timeout'] = '20'
+        changed = True
+    if general_conf.get('min capture timeout') is None:
+        general_conf['min capture timeout'] = '10'
+        changed = True
+    if general_conf.get('probe timeout') is None:
+        general_conf['probe timeout'] = '5'
+        changed = True
+    if general_conf.get('boot timeout') is None:
+        general_conf['boot timeout'] = '15'
+        changed = True
     if general_conf.get('db-backup interval') is None:
         general_conf['db-backup interval'] = '6'
         changed = True
@@ -436,15 +596,30 @@ if __name__ == '__main__':
     weekend_factor = general_conf.getint('weekend factor')
     retry_count = general_conf.getint('retry count')
     rescue_interval = general_conf.getint('rescue interval')
+    max_capture_timeout = general_conf.getint('max capture timeout')
+    min_capture_timeout = general_conf.getint('min capture timeout')
+    probe_timeout = general_conf.getint('probe timeout')
+    boot_timeout = general_conf.getint('boot timeout')
     db_backup_interval = timedelta(hours=general_conf.getint('db-backup interval'))
     db_backup_cleanup_days = general_conf.getint('db-backup cleanup days')
 
     # catch signals for clean exit
     watcher = KillWatcher()
 
-    # connect relays module and restart camera
-    camera = gpiozero.DigitalOutputDevice(pin=2, active_high=True)
-    restart_camera()
+    # connect relays module and restart the camera only if it doesn't respond
+    camera = gpiozero.DigitalOutputDevice(pin=2, active_high=True, initial_value=None)
+    monitor = CameraMonitor(camera, retry_count=retry_count, probe_timeout=probe_timeout,
+                            max_capture_timeout=max_capture_timeout, min_capture_timeout=min_capture_timeout,
+                            boot_timeout=boot_timeout)
+    if camera.value:
+        responsive = monitor.is_responsive()
+    else:
+        # a camera which just got power needs some time to boot
+        camera.on()
+        responsive = monitor.wait_for_boot()
+    if not responsive:
+        print('camera not responding - rebooting camera', flush=True)
+        monitor.power_cycle()
 
     # connect temperature sensor
     sensor = Adafruit_DHT.DHT11
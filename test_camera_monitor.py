@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+import subprocess
+import unittest
+from unittest import mock
+
+import BauCam
+from BauCam import CameraMonitor
+
+auto_detect_found = ('Model                          Port\n'
+                     '----------------------------------------------------------\n'
+                     'Canon EOS 600D                 usb:001,005\n')
+auto_detect_empty = ('Model                          Port\n'
+                     '----------------------------------------------------------\n')
+claim_error = ('*** Error ***\n'
+               'An error occurred in the io-library (\'Could not claim the USB device\'): Could not claim interface 0 '
+               '(Device or resource busy). Make sure no other program (gvfs-gphoto2-volume-monitor) or kernel module '
+               '(such as sdc2xx, stv680, spca50x) is using the device and you have read/write access to the device.\n')
+io_progress_error = ('*** Error ***\n'
+                     'An error occurred in the io-library (\'I/O in progress\'): I/O in progress\n')
+no_camera_error = '*** Error: No camera found. ***\n'
+focus_error = ('*** Error ***\n'
+               'Canon EOS Capture failed to release: Perhaps no focus?\n')
+
+
+class FakeRunner:
+    def __init__(self, output=auto_detect_found, timeout=False):
+        self.output = output
+        self.timeout = timeout
+        self.calls = []
+
+    def __call__(self, args, timeout, **kwargs):
+        self.calls.append(args)
+        if self.timeout:
+            raise subprocess.TimeoutExpired(args, timeout)
+        return subprocess.CompletedProcess(args, 0, stdout=self.output.encode())
+
+
+class CameraMonitorTest(unittest.TestCase):
+    def setUp(self):
+        # power cycles must not wait for real hardware
+        patcher = mock.patch.object(BauCam, 'sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.power = mock.Mock()
+        self.runner = FakeRunner()
+        self.monitor = CameraMonitor(self.power, runner=self.runner, retry_count=3, boot_timeout=1)
+
+    def test_classify_failure(self):
+        self.assertEqual('busy', self.monitor.classify_failure(claim_error))
+        self.assertEqual('busy', self.monitor.classify_failure(io_progress_error))
+        self.assertEqual('disconnected', self.monitor.classify_failure(no_camera_error))
+        self.assertEqual('focus', self.monitor.classify_failure(focus_error))
+        self.assertEqual('timeout', self.monitor.classify_failure(None))
+        self.assertEqual('unknown', self.monitor.classify_failure('*** Error ***\n'))
+
+    def test_is_responsive(self):
+        self.assertTrue(self.monitor.is_responsive())
+        self.runner.output = auto_detect_empty
+        self.assertFalse(self.monitor.is_responsive())
+        self.runner.output = no_camera_error
+        self.assertFalse(self.monitor.is_responsive())
+        self.runner.timeout = True
+        self.assertFalse(self.monitor.is_responsive())
+
+    def test_capture_timeout(self):
+        self.assertEqual(20, self.monitor.capture_timeout())
+        self.monitor.record_latency(2)
+        self.assertEqual(10, self.monitor.capture_timeout())
+        self.monitor.record_latency(10)
+        self.assertAlmostEqual(3 * (0.7 * 2 + 0.3 * 10), self.monitor.capture_timeout())
+
+        # a timeout is retried once at the maximum without touching the measured latency
+        self.assertEqual('retry', self.monitor.handle_failure(None, day=True))
+        self.assertEqual(20, self.monitor.capture_timeout())
+        self.assertEqual(0, self.monitor.camera_error)
+        self.assertAlmostEqual(0.7 * 2 + 0.3 * 10, self.monitor.latency)
+        self.assertIsNone(self.monitor.handle_failure(None, day=True))
+        self.assertEqual(1, self.monitor.camera_error)
+
+        self.monitor.record_latency(3)
+        self.assertLess(self.monitor.capture_timeout(), 20)
+
+    def test_busy_escalates_after_retries(self):
+        for attempt in range(3):
+            self.assertIsNone(self.monitor.handle_failure(claim_error, day=True))
+        self.assertEqual(0, self.monitor.camera_error)
+        self.power.off.assert_not_called()
+
+        # the busy retries are used up - further busy failures count and end in a reboot
+        actions = [self.monitor.handle_failure(io_progress_error, day=True) for attempt in range(3)]
+        self.assertEqual([None, None, 'reboot'], actions)
+        self.power.off.assert_called_once()
+
+    def test_responsive_camera_skips_power_cycle(self):
+        self.assertIsNone(self.monitor.handle_failure('*** Error ***\n', day=True))
+        self.power.off.assert_not_called()
+
+    def test_disconnected_camera_is_power_cycled(self):
+        self.assertIsNone(self.monitor.handle_failure(no_camera_error, day=True))
+        self.power.off.assert_called_once()
+        self.power.on.assert_called_once()
+
+    def test_reboot_only_after_failed_power_cycle(self):
+        self.runner.output = auto_detect_empty
+        self.assertIsNone(self.monitor.handle_failure(no_camera_error, day=True))
+        self.assertTrue(self.monitor.recovery_failed)
+        self.assertIsNone(self.monitor.handle_failure(no_camera_error, day=True))
+        self.assertEqual('reboot', self.monitor.handle_failure(no_camera_error, day=True))
+
+    def test_focus_failures_never_reboot(self):
+        self.monitor.handle_failure(no_camera_error, day=True)
+        for attempt in range(5):
+            self.assertIsNone(self.monitor.handle_failure(focus_error, day=True))
+        self.assertFalse(self.monitor.recovery_failed)
+        self.power.off.assert_called_once()
+
+    def test_night_resets_errors(self):
+        self.runner.output = auto_detect_empty
+        self.monitor.handle_failure(no_camera_error, day=True)
+        self.assertIsNone(self.monitor.handle_failure(no_camera_error, day=False))
+        self.assertEqual(0, self.monitor.camera_error)
+        self.assertFalse(self.monitor.recovery_failed)
+        self.assertFalse(self.monitor.power_cycled)
+
+
+if __name__ == '__main__':
+    unittest.main()